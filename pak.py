@@ -1,17 +1,31 @@
 # Source: http://www.metroid2002.com/retromodding/wiki/PAK_(Metroid_Prime)
 
+import array
 import dataclasses
+import mmap
 import struct
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from dgrp import DGRP
 from dumb import DUMB
 from hint import HINT
 from scan import SCAN
 from strg import STRG
 from tree import ScanTree
-from util import unpack_int, unpack_ascii, pack_int, pack_ascii
+from util import cache_packed, unpack_ascii, pack_int, pack_ascii
 
-__all__ = ("NamedResourceTable", "ResourceTable", "UnimplementedResource", "PAK")
+__all__ = (
+    "NamedResourceTable",
+    "ResourceTable",
+    "ResourceTableArray",
+    "ResourceArray",
+    "UnimplementedResource",
+    "PAK",
+)
 
 
 @dataclasses.dataclass(frozen=True)
@@ -25,7 +39,7 @@ class NamedResourceTable:
 
     @classmethod
     def from_packed(cls, packed: bytes):
-        asset_type_bytes, asset_ID, name_length = cls._struct.unpack(packed[:12])
+        asset_type_bytes, asset_ID, name_length = cls._struct.unpack_from(packed)
         return cls(
             unpack_ascii(asset_type_bytes),
             asset_ID,
@@ -35,7 +49,7 @@ class NamedResourceTable:
 
     @property
     def packed_size(self) -> int:
-        return len(self.packed())
+        return 12 + self.name_length
 
     def packed(self) -> bytes:
         return b"".join((
@@ -56,12 +70,12 @@ class ResourceTable:
 
     @classmethod
     def from_packed(cls, packed: bytes):
-        compressed_int, asset_type_bytes, asset_ID, size, offset = cls._struct.unpack(packed)
+        compressed_int, asset_type_bytes, asset_ID, size, offset = cls._struct.unpack_from(packed)
         return cls(bool(compressed_int), unpack_ascii(asset_type_bytes), asset_ID, size, offset)
 
     @property
     def packed_size(self) -> int:
-        return len(self.packed())
+        return self._struct.size
 
     def packed(self) -> bytes:
         return self._struct.pack(
@@ -73,6 +87,106 @@ class ResourceTable:
         )
 
 
+# Stores ResourceTable contents as (compressed, asset_type, asset_ID, size) rows plus a separate
+# offset column, so bulk offset shifts are array operations instead of one dataclass copy per resource.
+# ResourceTable instances are only materialized when an element is actually accessed.
+class ResourceTableArray:
+    __slots__ = ("_rows", "_offsets")
+
+    def __init__(self, rows, offsets):
+        self._rows = tuple(rows)
+        if numpy is not None:
+            if isinstance(offsets, numpy.ndarray):
+                self._offsets = offsets.astype(numpy.uint32, copy=False)
+            else:
+                self._offsets = numpy.fromiter(offsets, dtype=numpy.uint32)
+        elif isinstance(offsets, array.array):
+            self._offsets = offsets
+        else:
+            self._offsets = array.array("I", offsets)
+
+    @classmethod
+    def from_tables(cls, tables):
+        tables = tuple(tables)
+        return cls(
+            ((table.compressed, table.asset_type, table.asset_ID, table.size) for table in tables),
+            (table.offset for table in tables),
+        )
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self[i] for i in range(*index.indices(len(self._rows))))
+        return ResourceTable(*self._rows[index], int(self._offsets[index]))
+
+    def __iter__(self):
+        for row, offset in zip(self._rows, self._offsets):
+            yield ResourceTable(*row, int(offset))
+
+    def __eq__(self, other):
+        if isinstance(other, ResourceTableArray):
+            if self._rows != other._rows:
+                return False
+            if numpy is not None:
+                return bool(numpy.array_equal(self._offsets, other._offsets))
+            return self._offsets == other._offsets
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((self._rows, tuple(self._offsets)))
+
+    def __repr__(self):
+        return f"{type(self).__name__}(<{len(self._rows)} tables>)"
+
+    @property
+    def asset_IDs(self):
+        return tuple(asset_ID for compressed, asset_type, asset_ID, size in self._rows)
+
+    @property
+    def packed_size(self) -> int:
+        return ResourceTable._struct.size * len(self._rows)
+
+    def packed(self) -> bytes:
+        out = bytearray(self.packed_size)
+        self.pack_into(out, 0)
+        return bytes(out)
+
+    def pack_into(self, out: bytearray, cursor: int) -> int:
+        pack_into = ResourceTable._struct.pack_into
+        for (compressed, asset_type, asset_ID, size), offset in zip(self._rows, self._offsets):
+            pack_into(out, cursor, int(compressed), pack_ascii(asset_type), asset_ID, size, offset)
+            cursor += 20
+        return cursor
+
+    def with_table_inserted(self, index: int, table: ResourceTable, offset_delta: int):
+        if numpy is not None:
+            # One vectorized add over the shifted tail instead of a Python loop
+            new_offsets = numpy.empty(len(self._offsets) + 1, dtype=numpy.uint32)
+            new_offsets[:index] = self._offsets[:index]
+            new_offsets[index] = table.offset
+            new_offsets[index+1:] = self._offsets[index:]
+            new_offsets[index+1:] += offset_delta
+        else:
+            new_offsets = self._offsets[:index]
+            new_offsets.append(table.offset)
+            new_offsets.extend(offset + offset_delta for offset in self._offsets[index:])
+        return ResourceTableArray(
+            (*self._rows[:index], (table.compressed, table.asset_type, table.asset_ID, table.size),
+                *self._rows[index:]),
+            new_offsets,
+        )
+
+    def with_table_removed(self, index: int, offset_delta: int):
+        if numpy is not None:
+            new_offsets = numpy.concatenate((self._offsets[:index], self._offsets[index+1:] - offset_delta))
+        else:
+            new_offsets = self._offsets[:index]
+            new_offsets.extend(offset - offset_delta for offset in self._offsets[index+1:])
+        return ResourceTableArray((*self._rows[:index], *self._rows[index+1:]), new_offsets)
+
+
 @dataclasses.dataclass(frozen=True)
 class UnimplementedResource:
     data: bytes = dataclasses.field(repr=False)
@@ -89,9 +203,71 @@ class UnimplementedResource:
         return self.data
 
 
-def aligned_to_32_bytes(bytes_to_align: bytes):
-    padding = ((32 - (len(bytes_to_align) % 32)) % 32) * b"\xff"
-    return bytes_to_align + padding
+class _LazyResource:
+    __slots__ = ("asset_class", "raw")
+
+    def __init__(self, asset_class, raw):
+        self.asset_class = asset_class
+        self.raw = raw
+
+
+# Defers asset_class.from_packed until a resource is actually accessed, caching the parsed object;
+# serialization and size queries can use the raw bytes of untouched resources directly
+class ResourceArray:
+    __slots__ = ("_items",)
+
+    def __init__(self, items):
+        self._items = list(items)
+
+    def _parsed(self, index: int):
+        item = self._items[index]
+        if isinstance(item, _LazyResource):
+            item = item.asset_class.from_packed(bytes(item.raw))
+            self._items[index] = item
+        return item
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self._parsed(i) for i in range(*index.indices(len(self._items))))
+        return self._parsed(index)
+
+    def __iter__(self):
+        for index in range(len(self._items)):
+            yield self._parsed(index)
+
+    def __eq__(self, other):
+        if isinstance(other, ResourceArray):
+            return tuple(self) == tuple(other)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return f"{type(self).__name__}(<{len(self._items)} resources>)"
+
+    def packed_size_of(self, index: int) -> int:
+        item = self._items[index]
+        return len(item.raw) if isinstance(item, _LazyResource) else item.packed_size
+
+    def packed_sizes(self):
+        return (self.packed_size_of(index) for index in range(len(self._items)))
+
+    def packed_parts(self):
+        for item in self._items:
+            yield bytes(item.raw) if isinstance(item, _LazyResource) else item.packed()
+
+    def with_item_inserted(self, index: int, new_resource):
+        return ResourceArray((*self._items[:index], new_resource, *self._items[index:]))
+
+    def with_item_removed(self, index: int):
+        return ResourceArray((*self._items[:index], *self._items[index+1:]))
+
+
+_RESOURCE_PADDING = b"\xff" * 32
 
 @dataclasses.dataclass(frozen=True)
 class PAK:
@@ -115,38 +291,70 @@ class PAK:
     }
 
     def __post_init__(self):
+        if not isinstance(self.resource_tables, ResourceTableArray):
+            object.__setattr__(self, "resource_tables", ResourceTableArray.from_tables(self.resource_tables))
+        if not isinstance(self.resources, ResourceArray):
+            object.__setattr__(self, "resources", ResourceArray(self.resources))
+
         asset_ID_to_index_map = {}
-        for index, resource_table in enumerate(self.resource_tables):
-            asset_ID_to_index_map[resource_table.asset_ID] = index
+        for index, asset_ID in enumerate(self.resource_tables.asset_IDs):
+            asset_ID_to_index_map[asset_ID] = index
         object.__setattr__(self, "_asset_ID_to_index_map", asset_ID_to_index_map)
 
     @classmethod
-    def from_packed(cls, packed: bytes):
-        major_version, minor_version, unused, named_resource_count = cls._struct.unpack(packed[:12])
+    def from_file(cls, path):
+        # Mapping the archive lets the kernel page it in on demand instead of read() copying the
+        # whole file up front; the mapping stays alive while unparsed resources still view it
+        with open(path, "rb") as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls.from_packed(mapped)
+
+    @classmethod
+    def from_packed(cls, packed: bytes): # Accepts any bytes-like object, e.g. bytes, mmap, memoryview
+        mv = memoryview(packed) # Slicing a memoryview is zero-copy, unlike slicing bytes
+        major_version, minor_version, unused, named_resource_count = cls._struct.unpack_from(mv)
 
         offset = 12
         named_resource_tables = []
+        # The records are variable-length, so they can't be batched like the resource tables;
+        # unpack in place and construct directly to keep the per-record work minimal
+        unpack_named_header = NamedResourceTable._struct.unpack_from
+        append_named_resource_table = named_resource_tables.append
         for i in range(named_resource_count):
-            table = NamedResourceTable.from_packed(packed[offset:])
-            named_resource_tables.append(table)
-            offset += 12 + table.name_length
-
-        resource_count = unpack_int(packed[offset:offset+4])
+            asset_type_bytes, asset_ID, name_length = unpack_named_header(mv, offset)
+            append_named_resource_table(NamedResourceTable(
+                unpack_ascii(asset_type_bytes),
+                asset_ID,
+                name_length,
+                unpack_ascii(mv[offset+12:offset+12+name_length]),
+            ))
+            offset += 12 + name_length
+
+        resource_count = int.from_bytes(mv[offset:offset+4], "big")
         offset += 4
-        resource_tables = []
-        for i in range(resource_count):
-            resource_tables.append(ResourceTable.from_packed(packed[offset:offset+20]))
-            offset += 20
+        # One C-level iter_unpack pass instead of resource_count Python-level from_packed calls
+        unpacked_tables = list(ResourceTable._struct.iter_unpack(mv[offset:offset + 20*resource_count]))
+        rows = [
+            (bool(compressed_int), unpack_ascii(asset_type_bytes), asset_ID, size)
+            for compressed_int, asset_type_bytes, asset_ID, size, resource_offset in unpacked_tables
+        ]
+        if numpy is not None:
+            # Read the offset column straight out of the buffer as a strided array
+            resource_offsets = numpy.frombuffer(mv, dtype=">u4", count=5*resource_count, offset=offset)[4::5]
+        else:
+            resource_offsets = [fields[4] for fields in unpacked_tables]
+        resource_tables = ResourceTableArray(rows, resource_offsets)
+        offset += 20 * resource_count
 
         end_of_resource_tables_offset = offset
-        resources = []
-        for resource_table in resource_tables:
-            if resource_table.asset_ID == 0x95B61279:
-                asset_class = ScanTree
-            else:
-                asset_class = cls.asset_classes.get(resource_table.asset_type, UnimplementedResource)
-            offset, size = resource_table.offset, resource_table.size
-            resources.append(asset_class.from_packed(packed[offset:offset+size]))
+        # Resources are parsed on first access; untouched ones keep their zero-copy view of the input
+        resources = ResourceArray(
+            _LazyResource(
+                ScanTree if asset_ID == 0x95B61279 else cls.asset_classes.get(asset_type, UnimplementedResource),
+                mv[resource_offset:resource_offset+size],
+            )
+            for (compressed, asset_type, asset_ID, size), resource_offset in zip(rows, resource_offsets)
+        )
 
         return cls(
             major_version,
@@ -155,17 +363,16 @@ class PAK:
             named_resource_count,
             tuple(named_resource_tables),
             resource_count,
-            tuple(resource_tables),
-            tuple(resources),
+            resource_tables,
+            resources,
         )
 
     @property
     def packed_content_before_resources_size(self) -> int:
         named_resource_tables_size = \
             sum(named_resource_table.packed_size for named_resource_table in self.named_resource_tables)
-        resource_tables_size = sum(resource_table.packed_size for resource_table in self.resource_tables)
 
-        return 2 + 2 + 4 + 4 + named_resource_tables_size + 4 + resource_tables_size
+        return 2 + 2 + 4 + 4 + named_resource_tables_size + 4 + self.resource_tables.packed_size
 
     @property
     def packed_padding_before_resources_size(self) -> int:
@@ -173,18 +380,35 @@ class PAK:
 
     @property
     def packed_size(self) -> int:
-        resources_size = sum(resource.packed_size for resource in self.resources)
+        # Each resource is padded to 32 bytes when packed
+        resources_size = sum(size + (32 - (size % 32)) % 32 for size in self.resources.packed_sizes())
         return self.packed_content_before_resources_size + self.packed_padding_before_resources_size + resources_size
 
+    @cache_packed
     def packed(self) -> bytes:
-        return b"".join((
-            self._struct.pack(self.major_version, self.minor_version, self.unused, self.named_resource_count),
-            *(named_resource_table.packed() for named_resource_table in self.named_resource_tables),
-            pack_int(self.resource_count),
-            *(resource_table.packed() for resource_table in self.resource_tables),
-            b"\x00" * self.packed_padding_before_resources_size,
-            *(aligned_to_32_bytes(resource.packed()) for resource in self.resources),
-        ))
+        # packed_size is exact, so one preallocated buffer replaces the join over thousands of
+        # per-resource bytes objects
+        out = bytearray(self.packed_size)
+        self._struct.pack_into(out, 0, self.major_version, self.minor_version, self.unused, self.named_resource_count)
+        cursor = 12
+
+        for named_resource_table in self.named_resource_tables:
+            packed_table = named_resource_table.packed()
+            out[cursor:cursor+len(packed_table)] = packed_table
+            cursor += len(packed_table)
+
+        out[cursor:cursor+4] = pack_int(self.resource_count)
+        cursor = self.resource_tables.pack_into(out, cursor + 4)
+        cursor += self.packed_padding_before_resources_size # The padding is already zeroed
+
+        for packed_part in self.resources.packed_parts():
+            out[cursor:cursor+len(packed_part)] = packed_part
+            cursor += len(packed_part)
+            padding = (32 - (len(packed_part) % 32)) % 32
+            out[cursor:cursor+padding] = _RESOURCE_PADDING[:padding]
+            cursor += padding
+
+        return bytes(out)
 
     def get_resource_by_asset_ID(self, asset_ID: int):
         return self.resources[self._asset_ID_to_index_map[asset_ID]]
@@ -202,39 +426,27 @@ class PAK:
             new_resource_table_offset,
         )
 
-        new_resource_tables = [*self.resource_tables[:index], new_resource_table]
-        for resource_table in self.resource_tables[index:]:
-            new_resource_tables.append(
-                dataclasses.replace(resource_table, offset=resource_table.offset+new_resource.packed_size)
-            )
-
         return dataclasses.replace(
             self,
             resource_count=self.resource_count+1,
-            resource_tables=tuple(new_resource_tables),
-            resources=(*self.resources[:index], new_resource, *self.resources[index:])
+            resource_tables=self.resource_tables.with_table_inserted(
+                index, new_resource_table, new_resource.packed_size),
+            resources=self.resources.with_item_inserted(index, new_resource),
         )
 
     def with_resource_appended(self, asset_ID: int, new_resource):
         return self.with_resource_inserted(self.resource_count, asset_ID, new_resource)
 
     def with_resource_removed(self, index: int):
-        removed_resource = self.resources[index]
-        new_resource_tables = list(self.resource_tables[:index])
-        for resource_table in self.resource_tables[index+1:]:
-            new_resource_tables.append(
-                dataclasses.replace(resource_table, offset=resource_table.offset-removed_resource.packed_size)
-            )
-
         return dataclasses.replace(
             self,
             resource_count=self.resource_count-1,
-            resource_tables=tuple(new_resource_tables),
-            resources=self.resources[:index] + self.resources[index+1:],
+            resource_tables=self.resource_tables.with_table_removed(index, self.resources.packed_size_of(index)),
+            resources=self.resources.with_item_removed(index),
         )
 
     def with_resource_removed_by_asset_ID(self, asset_ID: int):
-        return self.with_resource_removed(self, self._asset_ID_to_index_map[asset_ID])
+        return self.with_resource_removed(self._asset_ID_to_index_map[asset_ID])
 
     def with_resource_replaced(self, index: int, new_resource):
         asset_ID = self.resource_tables[index].asset_ID
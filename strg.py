@@ -1,14 +1,35 @@
 # Source: http://www.metroid2002.com/retromodding/wiki/STRG_(Metroid_Prime)
 
 import dataclasses
+import functools
 import struct
 
-from util import unpack_ascii, unpack_null_terminated_ascii, unpack_null_terminated_utf_16, \
+try:
+    import numba
+    import numpy
+except ImportError:
+    numba = numpy = None
+
+from util import cache_packed, unpack_ascii, unpack_null_terminated_ascii, unpack_null_terminated_utf_16, \
     pack_ascii, pack_null_terminated_ascii, pack_null_terminated_utf_16
 
 __all__ = ("LanguageTable", "NameEntry", "NameTable", "StringTable", "STRG")
 
 
+if numba is not None:
+    # Walks each string two bytes at a time to its 16-bit null terminator; one compiled pass over
+    # all offsets replaces a Python-level scan per string. The strings are independent, so the
+    # scans run across cores with the GIL released
+    @numba.njit(cache=True, parallel=True)
+    def _find_utf_16_string_lengths(buffer, offsets, lengths):
+        for i in numba.prange(offsets.shape[0]):
+            offset = offsets[i]
+            length = 0
+            while buffer[offset + length] != 0 or buffer[offset + length + 1] != 0:
+                length += 2
+            lengths[i] = length
+
+
 @dataclasses.dataclass(frozen=True)
 class LanguageTable:
     _struct = struct.Struct(">4sII")
@@ -19,12 +40,12 @@ class LanguageTable:
 
     @classmethod
     def from_packed(cls, packed: bytes):
-        language_ID_bytes, strings_offset, strings_size = cls._struct.unpack(packed)
+        language_ID_bytes, strings_offset, strings_size = cls._struct.unpack_from(packed)
         return cls(unpack_ascii(language_ID_bytes), strings_offset, strings_size)
 
     @property
     def packed_size(self) -> int:
-        return len(self.packed())
+        return self._struct.size
 
     def packed(self) -> bytes:
         return self._struct.pack(
@@ -43,11 +64,11 @@ class NameEntry:
 
     @classmethod
     def from_packed(cls, packed: bytes):
-        return cls(*cls._struct.unpack(packed))
+        return cls(*cls._struct.unpack_from(packed))
 
     @property
     def packed_size(self) -> int:
-        return len(self.packed())
+        return self._struct.size
 
     def packed(self) -> bytes:
         return self._struct.pack(self.offset, self.string_index)
@@ -62,21 +83,25 @@ class NameTable:
     entries: tuple
     names: tuple
 
+    def __post_init__(self):
+        name_to_string_index_map = {}
+        for entry, name in zip(self.entries, self.names):
+            name_to_string_index_map[name] = entry.string_index
+        object.__setattr__(self, "_name_to_string_index_map", name_to_string_index_map)
+
     @classmethod
     def from_packed(cls, packed: bytes):
-        count, size = cls._struct.unpack(packed[:8])
+        mv = memoryview(packed)
+        count, size = cls._struct.unpack_from(mv)
 
-        offset = 8
-        entries = []
-        for i in range(count):
-            entries.append(NameEntry.from_packed(packed[offset:offset+8]))
-            offset += 8
+        entries = [NameEntry(*fields) for fields in NameEntry._struct.iter_unpack(mv[8:8 + 8*count])]
 
-        names = []
-        for entry in entries:
-            offset = 8 + entry.offset
-            name_length = packed[offset:].index(b"\x00")
-            names.append(unpack_null_terminated_ascii(packed[offset:offset+name_length+1]))
+        # The name scan needs bytes; materialize the table body (entry offsets are relative to it) once
+        body = bytes(mv[8:8+size])
+        names = [
+            unpack_null_terminated_ascii(body[entry.offset:body.index(b"\x00", entry.offset)+1])
+            for entry in entries
+        ]
 
         return cls(count, size, tuple(entries), tuple(names))
 
@@ -84,6 +109,7 @@ class NameTable:
     def packed_size(self) -> int:
         return len(self.packed())
 
+    @cache_packed
     def packed(self) -> bytes:
         return b"".join((
             self._struct.pack(self.count, self.size),
@@ -92,8 +118,40 @@ class NameTable:
         ))
 
     def get_string_index_for_name(self, name: str):
-        return self.entries[self.names.index(name)].string_index
-
+        return self._name_to_string_index_map[name]
+
+
+# The offset-array format string depends on the string count; cache the compiled Struct so
+# repeated loads don't re-parse it
+@functools.lru_cache(maxsize=None)
+def _string_offsets_struct(count: int) -> struct.Struct:
+    return struct.Struct(f">{count}I")
+
+def _strings_from_consecutive_offsets(packed: bytes, string_offsets: tuple):
+    # Well-formed tables store their strings back to back in index order, so each string ends
+    # where the next begins and the offset array alone determines every length; checking the
+    # implied terminator replaces a byte-by-byte scan per string. Returns None when the layout
+    # doesn't hold so the caller can fall back to scanning.
+    string_ends = (*string_offsets[1:], len(packed))
+
+    strings = []
+    for offset, end in zip(string_offsets, string_ends):
+        # A non-empty string's last code unit is non-null (it would have terminated earlier
+        # otherwise), so a null there means zero padding between strings rather than contiguity
+        if end - offset < 2 or (end - offset) % 2 or packed[end-2:end] != b"\x00\x00" \
+                or (end - offset > 2 and packed[end-4:end-2] == b"\x00\x00"):
+            return None
+        strings.append(unpack_null_terminated_utf_16(packed[offset:end]))
+
+    return strings
+
+def _utf_16_terminator_index(packed: bytes, offset: int) -> int:
+    # A 16-bit null sits at an even distance from the string start; a bare index(b"\x00\x00")
+    # could match a pair of zero bytes straddling two code units
+    index = packed.index(b"\x00\x00", offset)
+    while (index - offset) % 2:
+        index = packed.index(b"\x00\x00", index + 1)
+    return index
 
 @dataclasses.dataclass(frozen=True)
 class StringTable:
@@ -101,40 +159,76 @@ class StringTable:
     offsets: tuple
     strings: tuple
 
+    # Encoding is memoized per instance; with_string_replaced seeds the new instance's cache so
+    # only the replaced string is re-encoded
+    @property
+    def _encoded_strings(self) -> tuple:
+        try:
+            return self._cached_encoded_strings
+        except AttributeError:
+            object.__setattr__(
+                self,
+                "_cached_encoded_strings",
+                tuple(pack_null_terminated_utf_16(string) for string in self.strings),
+            )
+            return self._cached_encoded_strings
+
     @classmethod
     def from_packed(cls, packed: bytes, string_count: int):
-        string_offsets = struct.unpack(f">{string_count}I", packed[:4*string_count])
-
-        strings = []
-        for offset in string_offsets:
-            string_length = packed[offset:].index(b"\x00\x00")
-            strings.append(unpack_null_terminated_utf_16(packed[offset:offset+string_length+2]))
+        string_offsets = _string_offsets_struct(string_count).unpack_from(packed)
+
+        strings = _strings_from_consecutive_offsets(packed, string_offsets)
+        if strings is None:
+            if numba is not None and string_count > 0:
+                buffer = numpy.frombuffer(packed, dtype=numpy.uint8)
+                offsets = numpy.array(string_offsets, dtype=numpy.int64)
+                lengths = numpy.empty(string_count, dtype=numpy.int64)
+                _find_utf_16_string_lengths(buffer, offsets, lengths)
+                strings = [
+                    unpack_null_terminated_utf_16(packed[offset:offset+length+2])
+                    for offset, length in zip(string_offsets, lengths.tolist())
+                ]
+            else:
+                strings = [
+                    unpack_null_terminated_utf_16(packed[offset:_utf_16_terminator_index(packed, offset)+2])
+                    for offset in string_offsets
+                ]
 
         return cls(string_count, string_offsets, tuple(strings))
 
     @property
     def packed_size(self) -> int:
-        return len(self.packed())
+        return 4*self.count + sum(map(len, self._encoded_strings))
 
+    @cache_packed
     def packed(self) -> bytes:
-        return b"".join((
-            struct.pack(f">{self.count}I", *self.offsets),
-            *(pack_null_terminated_utf_16(string) for _, string in sorted(zip(self.offsets, self.strings))),
-        ))
+        out = bytearray(self.packed_size)
+        _string_offsets_struct(self.count).pack_into(out, 0, *self.offsets)
+        cursor = 4*self.count
 
-    def with_string_replaced(self, index: int, new_string: str):
-        size_diff = \
-            len(pack_null_terminated_utf_16(new_string)) - len(pack_null_terminated_utf_16(self.strings[index]))
+        # Strings are stored in string-index order, which already matches their offsets,
+        # so no sort is needed
+        for encoded_string in self._encoded_strings:
+            out[cursor:cursor+len(encoded_string)] = encoded_string
+            cursor += len(encoded_string)
 
-        new_offsets = list(self.offsets[:index+1])
-        for offset in self.offsets[index+1:]:
-            new_offsets.append(offset+size_diff)
+        return bytes(out)
 
-        return dataclasses.replace(
+    def with_string_replaced(self, index: int, new_string: str):
+        new_encoded_string = pack_null_terminated_utf_16(new_string)
+        size_diff = len(new_encoded_string) - len(self._encoded_strings[index])
+
+        new_string_table = dataclasses.replace(
             self,
-            offsets=tuple(new_offsets),
+            offsets=(*self.offsets[:index+1], *(offset + size_diff for offset in self.offsets[index+1:])),
             strings=(*self.strings[:index], new_string, *self.strings[index+1:]),
         )
+        object.__setattr__(
+            new_string_table,
+            "_cached_encoded_strings",
+            (*self._encoded_strings[:index], new_encoded_string, *self._encoded_strings[index+1:]),
+        )
+        return new_string_table
 
 
 @dataclasses.dataclass(frozen=True)
@@ -159,21 +253,27 @@ class STRG:
 
     @classmethod
     def from_packed(cls, packed: bytes):
-        magic_number, version, language_count, string_count = cls._struct.unpack(packed[:16])
+        mv = memoryview(packed) # Slicing a memoryview is zero-copy, unlike slicing bytes
+        magic_number, version, language_count, string_count = cls._struct.unpack_from(mv)
 
-        offset = 16
-        language_tables = []
-        for i in range(language_count):
-            language_tables.append(LanguageTable.from_packed(packed[offset:offset+12]))
-            offset += 12
+        offset = 16 + 12*language_count
+        language_tables = [
+            LanguageTable(unpack_ascii(language_ID_bytes), strings_offset, strings_size)
+            for language_ID_bytes, strings_offset, strings_size
+            in LanguageTable._struct.iter_unpack(mv[16:offset])
+        ]
 
-        name_table = NameTable.from_packed(packed[offset:])
+        name_table = NameTable.from_packed(mv[offset:])
         string_tables_offset = offset + 8 + name_table.size
 
-        string_tables = []
-        for language_table in language_tables:
-            offset, size = string_tables_offset + language_table.strings_offset, language_table.strings_size
-            string_tables.append(StringTable.from_packed(packed[offset:offset+size], string_count))
+        string_tables = [
+            StringTable.from_packed(
+                bytes(mv[string_tables_offset + language_table.strings_offset
+                    :string_tables_offset + language_table.strings_offset + language_table.strings_size]),
+                string_count,
+            )
+            for language_table in language_tables
+        ]
 
         return cls(
             magic_number,
@@ -192,13 +292,27 @@ class STRG:
 
         return 4 + 4 + 4 + 4 + language_tables_size + self.name_table.packed_size + string_tables_size
 
+    @cache_packed
     def packed(self) -> bytes:
-        return b"".join((
-            self._struct.pack(self.magic_number, self.version, self.language_count, self.string_count),
-            *(language_table.packed() for language_table in self.language_tables),
-            self.name_table.packed(),
-            *(string_table.packed() for string_table in self.string_tables),
-        ))
+        out = bytearray(self.packed_size)
+        self._struct.pack_into(out, 0, self.magic_number, self.version, self.language_count, self.string_count)
+        cursor = 16
+
+        for language_table in self.language_tables:
+            LanguageTable._struct.pack_into(
+                out,
+                cursor,
+                pack_ascii(language_table.language_ID),
+                language_table.strings_offset,
+                language_table.strings_size,
+            )
+            cursor += 12
+
+        for packed_part in (self.name_table.packed(), *(string_table.packed() for string_table in self.string_tables)):
+            out[cursor:cursor+len(packed_part)] = packed_part
+            cursor += len(packed_part)
+
+        return bytes(out)
 
     def get_string_table_by_language_ID(self, language_ID: str) -> StringTable:
         return self.string_tables[self._language_ID_to_index_map[language_ID]]
@@ -208,15 +322,16 @@ class STRG:
         new_language_table = dataclasses.replace(old_language_table, strings_size=new_string_table.packed_size)
 
         size_diff = new_language_table.strings_size - old_language_table.strings_size
-        new_language_tables = [*self.language_tables[:index], new_language_table]
-        for language_table in self.language_tables[index+1:]:
-            new_language_tables.append(
-                dataclasses.replace(language_table, strings_offset=language_table.strings_size+size_diff)
-            )
+        new_language_tables = (
+            *self.language_tables[:index],
+            new_language_table,
+            *(dataclasses.replace(language_table, strings_offset=language_table.strings_offset+size_diff)
+                for language_table in self.language_tables[index+1:]),
+        )
 
         return dataclasses.replace(
             self,
-            language_tables=tuple(new_language_tables),
+            language_tables=new_language_tables,
             string_tables=(*self.string_tables[:index], new_string_table, *self.string_tables[index+1:]),
         )
 
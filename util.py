@@ -3,6 +3,7 @@ import functools
 import struct
 
 __all__ = (
+    "cache_packed",
     "unpack_bool",
     "unpack_bool_from_int",
     "unpack_int",
@@ -22,6 +23,18 @@ INT_STRUCT   = struct.Struct(">I")
 FLOAT_STRUCT = struct.Struct(">f")
 
 
+# Memoizes packed() on a frozen dataclass; instances are immutable, so the result never changes
+def cache_packed(compute_packed):
+    @functools.wraps(compute_packed)
+    def packed(self) -> bytes:
+        try:
+            return self._cached_packed
+        except AttributeError:
+            object.__setattr__(self, "_cached_packed", compute_packed(self))
+            return self._cached_packed
+    return packed
+
+
 # Unpacking
 def unpack_bool(packed: bytes) -> bool:
     return BOOL_STRUCT.unpack(packed)[0]
@@ -36,13 +49,14 @@ def unpack_float(packed: bytes) -> float:
     return FLOAT_STRUCT.unpack(packed)[0]
 
 def unpack_ascii(packed: bytes):
-    return packed.decode("ascii")
+    # bytes() is a no-op for bytes and materializes memoryview slices
+    return bytes(packed).decode("ascii")
 
 def unpack_null_terminated_ascii(packed: bytes) -> str:
-    return packed[:-1].decode("ascii")
+    return bytes(packed[:-1]).decode("ascii")
 
 def unpack_null_terminated_utf_16(packed: bytes) -> str:
-    return packed[:-2].decode("utf-16-be")
+    return bytes(packed[:-2]).decode("utf-16-be")
 
 
 # Packing